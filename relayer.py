@@ -1,69 +1,801 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
-from web3 import Web3
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from web3 import AsyncWeb3, Web3
+from web3.exceptions import TransactionNotFound, Web3RPCError
+from eth_abi import encode
+from eth_utils import function_signature_to_4byte_selector, keccak, to_canonical_address
 from typing import Optional
+import aiohttp
+import asyncio
+import heapq
+import orjson
 import os
-import requests
+import pathlib
+import re
+import redis.asyncio as redis
+import statistics
+import time
 import traceback
 
-app = FastAPI()
-
 # ================== CONFIGURACIÓN BLOCKCHAIN ==================
-RPC_URL = os.getenv("RPC_URL")
-if not RPC_URL:
-    raise ValueError("RPC_URL no está definida en variables de entorno")
-
-PRIVATE_KEY = os.getenv("PRIVATE_KEY")
-if not PRIVATE_KEY:
-    raise ValueError("PRIVATE_KEY no está definida en variables de entorno")
+def env_requerida(nombre: str) -> str:
+    valor = os.getenv(nombre)
+    if not valor:
+        raise ValueError(f"{nombre} no está definida en variables de entorno")
+    return valor
 
-CONTRACT_ADDRESS_RAW = os.getenv("CONTRACT_ADDRESS")
-if not CONTRACT_ADDRESS_RAW:
-    raise ValueError("CONTRACT_ADDRESS no está definida en variables de entorno")
-CONTRACT_ADDRESS = Web3.to_checksum_address(CONTRACT_ADDRESS_RAW)
 
-CHAIN_ID_STR = os.getenv("CHAIN_ID")
-if not CHAIN_ID_STR:
-    raise ValueError("CHAIN_ID no está definida en variables de entorno")
-CHAIN_ID = int(CHAIN_ID_STR)
+RPC_URL = env_requerida("RPC_URL")
+PRIVATE_KEY = env_requerida("PRIVATE_KEY")
+CONTRACT_ADDRESS = Web3.to_checksum_address(env_requerida("CONTRACT_ADDRESS").strip())
+# 20 bytes crudos para el campo "to" al firmar (evita re-normalizar el checksum por tx)
+CONTRACT_BYTES = to_canonical_address(CONTRACT_ADDRESS)
+CHAIN_ID = int(env_requerida("CHAIN_ID"))
 
 PINATA_JWT = os.getenv("PINATA_JWT")
 
-# ABI CORRECTO (SIN CID)
-ABI_JSON = [
-    {
-        "inputs": [
-            {"internalType": "string", "name": "deviceId", "type": "string"},
-            {"internalType": "int16", "name": "temperatureTimes10", "type": "int16"},
-            {"internalType": "uint16", "name": "humidityTimes10", "type": "uint16"},
-            {"internalType": "uint256", "name": "timestampMs", "type": "uint256"}
-        ],
-        "name": "storeReading",
-        "outputs": [],
-        "stateMutability": "nonpayable",
-        "type": "function",
-    }
-]
+# Lecturas numéricas pequeñas ya viajan tipadas al contrato: solo se suben a IPFS
+# si el payload supera este tamaño o trae imagen
+PINATA_UMBRAL_BYTES = int(os.getenv("PINATA_UMBRAL_BYTES", "1024"))
+
+# Un único relayer para todas las variantes: comparten w3, cuenta, cliente de
+# Pinata y caché de nonce, así nunca hay dos procesos compitiendo por el nonce.
+# "directo": una tx por lectura | "lote": varias lecturas por tx vía storeReadings
+# "merkle": solo la raíz Merkle del lote va on-chain (commitBatch); las lecturas quedan en IPFS
+MODO = os.getenv("MODO", "directo")
+if MODO not in ("directo", "lote", "merkle"):
+    raise ValueError(f"MODO inválido: {MODO} (usa 'directo', 'lote' o 'merkle')")
+if MODO == "merkle" and not PINATA_JWT:
+    raise ValueError("MODO=merkle requiere PINATA_JWT para publicar el manifiesto del lote")
+
+# Con varios workers de uvicorn el nonce debe vivir fuera del proceso: si
+# REDIS_URL está definida se usa Redis (contador atómico por cuenta emisora)
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Rangos de los campos escalados x10 en el contrato (int16 / uint16)
+INT16_MIN, INT16_MAX = -2**15, 2**15 - 1
+UINT16_MAX = 2**16 - 1
+DEVICE_ID_MAX_CHARS = 128
+
+LOTE_MAX_LECTURAS = int(os.getenv("LOTE_MAX_LECTURAS", "50"))
+LOTE_MAX_ESPERA_MS = int(os.getenv("LOTE_MAX_ESPERA_MS", "2000"))
+
+# ABI CORRECTO (SIN CID): se parsea una sola vez al importar
+ABI_PATH = pathlib.Path(__file__).with_name("abi.json")
+ABI_JSON = orjson.loads(ABI_PATH.read_bytes())
+
+
+
+def firma_abi(nombre: str) -> tuple:
+    """Devuelve (selector, tipos) de la función `nombre` del ABI."""
+    funcion = next(f for f in ABI_JSON if f.get("type") == "function" and f["name"] == nombre)
+    tipos = [i["type"] for i in funcion["inputs"]]
+    return function_signature_to_4byte_selector(f"{nombre}({','.join(tipos)})"), tipos
+
+
+# Selectores y tipos precalculados: el calldata se codifica a mano con eth_abi
+# en vez de pasar por contract.functions...build_transaction en cada tx.
+SELECTOR_STORE_READING, TIPOS_STORE_READING = firma_abi("storeReading")
+SELECTOR_STORE_READINGS, TIPOS_STORE_READINGS = firma_abi("storeReadings")
+SELECTOR_COMMIT_BATCH, TIPOS_COMMIT_BATCH = firma_abi("commitBatch")
 
 PINATA_URL = "https://api.pinata.cloud/pinning/pinJSONToIPFS"
+PINATA_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+# Una sola sesión aiohttp (keep-alive + caché DNS) compartida por Pinata y el
+# proveedor RPC; se abre y se cierra en el lifespan de la app.
+http_state = {"session": None}
 
 # ================== INICIALIZACIÓN WEB3 ==================
-w3 = Web3(Web3.HTTPProvider(RPC_URL))
-if not w3.is_connected():
-    raise RuntimeError("No se pudo conectar al nodo RPC. Revisa RPC_URL / Internet.")
+w3 = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(
+    RPC_URL,
+    request_kwargs={"timeout": aiohttp.ClientTimeout(total=20)},
+))
 
 account = w3.eth.account.from_key(PRIVATE_KEY)
 print("[INFO] Relayer usando cuenta:", account.address)
-print("[INFO] Saldo actual:", w3.eth.get_balance(account.address))
 
-contract = w3.eth.contract(address=CONTRACT_ADDRESS, abi=ABI_JSON)
+
+# ================== CACHÉ DE NONCE Y TARIFAS ==================
+# Nonce local: se siembra una vez desde el nodo y se incrementa en proceso,
+# así dos peticiones concurrentes nunca reciben el mismo nonce. Los nonces de
+# envíos fallidos vuelven a "libres" y se reutilizan primero (sin dejar huecos).
+# "en_vuelo" son los asignados aún sin difundir; "hueco" recuerda el último
+# hueco sospechoso para confirmarlo en la siguiente revisión.
+nonce_state = {"value": 0, "libres": [], "en_vuelo": set(), "hueco": None}
+nonce_lock = asyncio.Lock()
+
+# Revisión periódica de huecos: si no hay envíos en vuelo y el contador va por
+# delante del nonce "pending" del nodo, ese nonce se perdió (p. ej. un envío
+# cancelado al apagar) y las tx posteriores quedarían en cola para siempre.
+NONCE_REVISION_S = 30
+# Una entrada en vuelo más antigua que esto (worker caído) deja de contar
+NONCE_EN_VUELO_MAX_S = 120
+
+# Variante compartida entre workers: mismo esquema en Redis (contador, sorted
+# set de libres y sorted set de en vuelo por timestamp), con scripts Lua para
+# que cada operación sea atómica. Las claves incluyen la cadena: la misma
+# cuenta en otra red lleva su propio nonce.
+redis_state = {"client": None, "scripts": {}}
+CLAVES_NONCE = [
+    f"relayer:{CHAIN_ID}:nonce:{account.address}",
+    f"relayer:{CHAIN_ID}:nonces_libres:{account.address}",
+    f"relayer:{CHAIN_ID}:nonces_en_vuelo:{account.address}",
+]
+
+# ARGV[1] = timestamp actual
+LUA_SIGUIENTE_NONCE = """
+local n
+local libre = redis.call('ZRANGE', KEYS[2], 0, 0)
+if libre[1] then
+    redis.call('ZREM', KEYS[2], libre[1])
+    n = tonumber(libre[1])
+else
+    n = redis.call('INCR', KEYS[1]) - 1
+end
+redis.call('ZADD', KEYS[3], ARGV[1], n)
+return n
+"""
+
+# ARGV[1] = nonce, ARGV[2] = "1" para devolverlo al pool de libres
+LUA_TERMINAR_NONCE = """
+redis.call('ZREM', KEYS[3], ARGV[1])
+if ARGV[2] == '1' then
+    redis.call('ZADD', KEYS[2], ARGV[1], ARGV[1])
+end
+return 1
+"""
+
+# ARGV[1] = nonce pendiente según el nodo, ARGV[2] = "1" al arrancar,
+# ARGV[3] = límite de antigüedad en vuelo. Normalmente solo se avanza: el
+# contador es compartido y otros workers pueden tener nonces asignados aún sin
+# difundir. Al arrancar sin nonces en vuelo se iguala al nodo también hacia
+# atrás (Redis restaurado de una copia vieja, tx descartadas con el servicio caído).
+LUA_SINCRONIZAR_NONCE = """
+local actual = tonumber(redis.call('GET', KEYS[1]) or '0')
+local pendiente = tonumber(ARGV[1])
+if ARGV[2] == '1' then
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', ARGV[3])
+end
+if ARGV[2] == '1' and redis.call('ZCARD', KEYS[3]) == 0 then
+    redis.call('SET', KEYS[1], pendiente)
+    redis.call('DEL', KEYS[2])
+elseif pendiente > actual then
+    redis.call('SET', KEYS[1], pendiente)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', pendiente - 1)
+return tonumber(redis.call('GET', KEYS[1]))
+"""
+
+# ARGV[1] = nonce pendiente según el nodo, ARGV[2] = límite de antigüedad en vuelo.
+# Devuelve el nonce perdido o -1 si no hay hueco.
+LUA_REVISAR_HUECO = """
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[3]) > 0 then
+    return -1
+end
+local actual = tonumber(redis.call('GET', KEYS[1]) or '0')
+local pendiente = tonumber(ARGV[1])
+if actual <= pendiente or redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return -1
+end
+return pendiente
+"""
+
+# Tarifas EIP-1559 (tx tipo 2): las refresca una tarea de fondo a partir de
+# eth_feeHistory, las peticiones solo las leen
+TARIFAS_REFRESCO_S = 6  # ~tiempo de bloque en Sepolia
+TARIFAS_BLOQUES = 20
+TARIFAS_PERCENTIL_TIP = 50
+tarifas_cache = {}
+
+# Límite de gas de storeReading: se estima una vez al arrancar (300000 si la estimación falla)
+# con un device_id de DEVICE_ID_GAS_BYTES bytes; ids más largos estiman su propio gas
+MARGEN_GAS = 1.2
+DEVICE_ID_GAS_BYTES = 64
+gas_state = {"storeReading": 300000}
+
+
+async def conectar_redis():
+    cliente = redis.from_url(REDIS_URL)
+    redis_state["client"] = cliente
+    redis_state["scripts"] = {
+        "siguiente": cliente.register_script(LUA_SIGUIENTE_NONCE),
+        "terminar": cliente.register_script(LUA_TERMINAR_NONCE),
+        "sincronizar": cliente.register_script(LUA_SINCRONIZAR_NONCE),
+        "revisar_hueco": cliente.register_script(LUA_REVISAR_HUECO),
+    }
+    print("[INFO] Nonce compartido en Redis:", CLAVES_NONCE[0])
+
+
+async def sincronizar_nonce(arranque: bool = False):
+    """Avanza el nonce hasta el "pending" del nodo. Llamar con `nonce_lock` tomado.
+
+    Fuera del arranque nunca retrocede: otros trabajadores (o workers, con
+    Redis) pueden tener nonces asignados aún sin difundir. Con `arranque` y
+    ningún nonce en vuelo se iguala al nodo aunque el contador vaya por delante.
+    """
+    pendiente = await w3.eth.get_transaction_count(account.address, "pending")
+
+    if redis_state["client"] is not None:
+        valor = await redis_state["scripts"]["sincronizar"](
+            keys=CLAVES_NONCE,
+            args=[pendiente, "1" if arranque else "0", time.time() - NONCE_EN_VUELO_MAX_S],
+        )
+        print("[INFO] Nonce sincronizado con el nodo (Redis):", valor)
+        return
+
+    if arranque and not nonce_state["en_vuelo"]:
+        nonce_state["value"] = pendiente
+        nonce_state["libres"] = []
+    nonce_state["value"] = max(nonce_state["value"], pendiente)
+    nonce_state["libres"] = [n for n in nonce_state["libres"] if n >= pendiente]
+    heapq.heapify(nonce_state["libres"])
+    print("[INFO] Nonce sincronizado con el nodo:", nonce_state["value"])
+
+
+async def siguiente_nonce() -> int:
+    if redis_state["client"] is not None:
+        return int(await redis_state["scripts"]["siguiente"](keys=CLAVES_NONCE, args=[time.time()]))
+
+    async with nonce_lock:
+        if nonce_state["libres"]:
+            n = heapq.heappop(nonce_state["libres"])
+        else:
+            n = nonce_state["value"]
+            nonce_state["value"] += 1
+        nonce_state["en_vuelo"].add(n)
+        return n
+
+
+async def terminar_nonce(nonce: int, devolver: bool):
+    """Saca `nonce` de los envíos en vuelo; con `devolver` vuelve al pool de libres."""
+    if redis_state["client"] is not None:
+        await redis_state["scripts"]["terminar"](keys=CLAVES_NONCE, args=[nonce, "1" if devolver else "0"])
+        return
+
+    nonce_state["en_vuelo"].discard(nonce)
+    if devolver and nonce not in nonce_state["libres"]:
+        heapq.heappush(nonce_state["libres"], nonce)
+
+
+async def revisar_hueco_nonce():
+    pendiente = await w3.eth.get_transaction_count(account.address, "pending")
+
+    if redis_state["client"] is not None:
+        hueco = await redis_state["scripts"]["revisar_hueco"](
+            keys=CLAVES_NONCE, args=[pendiente, time.time() - NONCE_EN_VUELO_MAX_S]
+        )
+        hueco = None if hueco < 0 else int(hueco)
+    elif (
+        not nonce_state["en_vuelo"]
+        and nonce_state["value"] > pendiente
+        and pendiente not in nonce_state["libres"]
+    ):
+        hueco = pendiente
+    else:
+        hueco = None
+
+    # Se exige verlo en dos revisiones seguidas (el nodo puede ir un poco por detrás)
+    if hueco is not None and hueco == nonce_state["hueco"]:
+        print("[WARN] Nonce perdido detectado, se devuelve al pool:", hueco)
+        await terminar_nonce(hueco, devolver=True)
+        hueco = None
+    nonce_state["hueco"] = hueco
+
+
+async def vigilante_nonce():
+    while True:
+        await asyncio.sleep(NONCE_REVISION_S)
+        try:
+            await revisar_hueco_nonce()
+        except Exception as e:
+            print("[WARN] No se pudo revisar el nonce:", e)
+
+
+async def refrescar_tarifas():
+    historial = await w3.eth.fee_history(TARIFAS_BLOQUES, "latest", [TARIFAS_PERCENTIL_TIP])
+    # El último baseFee es el del próximo bloque; +12.5% cubre una subida máxima
+    base_siguiente = int(historial["baseFeePerGas"][-1] * 1.125)
+    recompensas = [r[0] for r in historial["reward"]]
+    tip = int(statistics.median(recompensas)) if recompensas else await w3.eth.max_priority_fee
+
+    tarifas_cache["maxFeePerGas"] = base_siguiente + tip
+    tarifas_cache["maxPriorityFeePerGas"] = tip
+
+
+async def refrescador_tarifas():
+    while True:
+        await asyncio.sleep(TARIFAS_REFRESCO_S)
+        try:
+            await refrescar_tarifas()
+        except Exception as e:
+            print("[WARN] No se pudieron refrescar las tarifas:", e)
+
+
+async def estimar_gas_store_reading():
+    # Device id largo y nuevo: cubre el peor caso de almacenamiento
+    data = SELECTOR_STORE_READING + encode(
+        TIPOS_STORE_READING, ["x" * DEVICE_ID_GAS_BYTES, 250, 500, int(time.time() * 1000)]
+    )
+    try:
+        estimado = await w3.eth.estimate_gas(
+            {"from": account.address, "to": CONTRACT_ADDRESS, "data": data}
+        )
+    except Exception as e:
+        print("[WARN] No se pudo estimar el gas de storeReading, se usa", gas_state["storeReading"], ":", e)
+        return
+    gas_state["storeReading"] = int(estimado * MARGEN_GAS)
+    print("[INFO] Límite de gas de storeReading:", gas_state["storeReading"])
+
+
+# Errores del nodo que indican que el nonce ya está usado (por otra tx o por esta misma)
+ERRORES_NONCE_USADO = ("nonce", "already known", "replacement transaction underpriced")
+
+
+def es_error_de_nonce(e: Exception) -> bool:
+    mensaje = str(e).lower()
+    return isinstance(e, (ValueError, Web3RPCError)) and any(m in mensaje for m in ERRORES_NONCE_USADO)
+
+
+# ================== RECIBOS EN SEGUNDO PLANO ==================
+# El endpoint responde en cuanto la tx se difunde; el recibo se espera aquí
+# y se consulta después con GET /api/tx/{tx_hash}. Un único sondeador revisa
+# todas las tx pendientes una vez por bloque nuevo (no un bucle por tx), así
+# las consultas de recibos no compiten con los envíos por la RPC.
+MAX_RECIBOS = 1000
+recibos = {}
+# clave -> instante de envío (time.monotonic) de las tx aún sin recibo
+recibos_pendientes = {}
+RECIBOS_SONDEO_S = 4
+RECIBOS_CONCURRENCIA = 16
+# Pasado este tiempo sin recibo se deja de sondear y se olvida la entrada:
+# GET /api/tx/{tx_hash} pasa a preguntar al nodo (la tx puede minarse más tarde)
+RECIBO_MAX_ESPERA_S = 600
+
+
+HASH_32_BYTES = re.compile(r"(0x)?[0-9a-fA-F]{64}")
+
+
+def clave_tx(tx_hash: str) -> str:
+    return tx_hash.lower().removeprefix("0x")
+
+
+def esperar_recibo_en_segundo_plano(tx_hash: bytes):
+    clave = clave_tx(tx_hash.hex())
+    recibos[clave] = {"status": "pending"}
+    recibos_pendientes[clave] = time.monotonic()
+    while len(recibos) > MAX_RECIBOS:
+        recibos_pendientes.pop(recibos.pop(next(iter(recibos))), None)
+
+
+async def revisar_recibo(clave: str, enviada: float, limite: asyncio.Semaphore):
+    async with limite:
+        try:
+            receipt = await w3.eth.get_transaction_receipt("0x" + clave)
+        except TransactionNotFound:
+            if time.monotonic() - enviada > RECIBO_MAX_ESPERA_S:
+                print("[WARN] Sin recibo tras", RECIBO_MAX_ESPERA_S, "s, se deja de sondear:", clave)
+                recibos_pendientes.pop(clave, None)
+                recibos.pop(clave, None)
+            return
+
+    print("[INFO] Tx minada en bloque:", receipt.blockNumber)
+    if recibos_pendientes.pop(clave, None) is not None:
+        recibos[clave] = {
+            "status": "ok" if receipt.status == 1 else "reverted",
+            "block": receipt.blockNumber,
+        }
+
+
+async def revisar_recibos():
+    limite = asyncio.Semaphore(RECIBOS_CONCURRENCIA)
+    resultados = await asyncio.gather(
+        *(revisar_recibo(clave, enviada, limite) for clave, enviada in list(recibos_pendientes.items())),
+        return_exceptions=True,
+    )
+    # Los errores de RPC no marcan la tx como fallida: se reintenta en el siguiente bloque
+    for r in resultados:
+        if isinstance(r, Exception):
+            print("[WARN] No se pudo consultar un recibo:", r)
+
+
+async def sondeador_recibos():
+    ultimo_bloque = None
+    while True:
+        await asyncio.sleep(RECIBOS_SONDEO_S)
+        if not recibos_pendientes:
+            continue
+        try:
+            bloque = await w3.eth.block_number
+            if bloque != ultimo_bloque:
+                await revisar_recibos()
+                ultimo_bloque = bloque
+        except Exception as e:
+            print("[WARN] No se pudieron revisar los recibos:", e)
+
+
+# ================== ÁRBOL MERKLE (MODO=merkle) ==================
+# Hoja = keccak(abi.encode(deviceId, temp10, hum10, timestampMs, cid)); los pares
+# se hashean ordenados (compatible con MerkleProof de OpenZeppelin).
+MAX_PRUEBAS = 10000
+pruebas = {}
+# Con Redis las pruebas se comparten entre workers (con caducidad)
+PRUEBAS_TTL_S = 7 * 24 * 3600
+
+
+def hoja_merkle(device_id: str, temp_times10: int, hum_times10: int, timestamp_ms: int, cid: str) -> bytes:
+    return keccak(encode(
+        ["string", "int16", "uint16", "uint256", "string"],
+        [device_id, temp_times10, hum_times10, timestamp_ms, cid],
+    ))
+
+
+def construir_arbol_merkle(hojas: list) -> list:
+    """Devuelve los niveles del árbol, de las hojas (niveles[0]) a la raíz (niveles[-1][0])."""
+    niveles = [hojas]
+    while len(niveles[-1]) > 1:
+        nivel = niveles[-1]
+        siguiente = []
+        for i in range(0, len(nivel) - 1, 2):
+            a, b = sorted((nivel[i], nivel[i + 1]))
+            siguiente.append(keccak(a + b))
+        if len(nivel) % 2:
+            # Nodo sin pareja: sube tal cual
+            siguiente.append(nivel[-1])
+        niveles.append(siguiente)
+    return niveles
+
+
+def prueba_merkle(niveles: list, indice: int) -> list:
+    prueba = []
+    for nivel in niveles[:-1]:
+        hermano = indice ^ 1
+        if hermano < len(nivel):
+            prueba.append(nivel[hermano])
+        indice //= 2
+    return prueba
+
+
+async def registrar_pruebas(niveles: list, tx_hash: bytes, manifest_cid: str):
+    raiz = "0x" + niveles[-1][0].hex()
+    nuevas = {
+        "0x" + hoja.hex(): {
+            "root": raiz,
+            "proof": ["0x" + h.hex() for h in prueba_merkle(niveles, i)],
+            "manifest_cid": manifest_cid,
+            "tx_hash": tx_hash.hex(),
+        }
+        for i, hoja in enumerate(niveles[0])
+    }
+
+    if redis_state["client"] is not None:
+        async with redis_state["client"].pipeline(transaction=False) as pipe:
+            for hoja, prueba in nuevas.items():
+                pipe.set(f"relayer:proof:{hoja}", orjson.dumps(prueba), ex=PRUEBAS_TTL_S)
+            await pipe.execute()
+        return
+
+    pruebas.update(nuevas)
+    while len(pruebas) > MAX_PRUEBAS:
+        pruebas.pop(next(iter(pruebas)))
+
+
+async def buscar_prueba(hoja: str) -> Optional[dict]:
+    if redis_state["client"] is not None:
+        valor = await redis_state["client"].get(f"relayer:proof:{hoja}")
+        return orjson.loads(valor) if valor is not None else None
+    return pruebas.get(hoja)
+
+
+# ================== PIPELINE DE ENVÍOS ==================
+# Un pool de trabajadores drena la cola de envíos: cada uno toma el siguiente
+# nonce, firma y difunde sin esperar a los demás (el mempool ordena por nonce),
+# así el throughput queda limitado por la RPC y no por el tiempo de bloque.
+ENVIO_TRABAJADORES = int(os.getenv("ENVIO_TRABAJADORES", "8"))
+ENVIO_MAX_REINTENTOS = 1
+cola_envios = asyncio.Queue()
+
+
+async def liberar_nonce(nonce: int, e: Exception):
+    """Devuelve al pool un nonce cuyo envío falló.
+
+    Si el nodo indica que el nonce ya está usado se descarta (no vuelve al pool)
+    y se resincroniza hacia delante.
+    """
+    if not es_error_de_nonce(e):
+        await terminar_nonce(nonce, devolver=True)
+        return
+
+    print("[WARN] Nonce desfasado, resincronizando:", e)
+    await terminar_nonce(nonce, devolver=False)
+    async with nonce_lock:
+        await sincronizar_nonce()
+
+
+async def enviar_transaccion(data: bytes, gas: Optional[int]) -> bytes:
+    """Construye, firma y envía una tx al contrato con calldata `data` y el nonce cacheado.
+
+    Con `gas=None` el límite de gas lo estima el nodo. Si el envío falla se
+    libera el nonce (para no dejar huecos) y se propaga el error.
+    """
+    if gas is None:
+        gas = await w3.eth.estimate_gas(
+            {"from": account.address, "to": CONTRACT_ADDRESS, "data": data}
+        )
+
+    nonce = await siguiente_nonce()
+    print("[INFO] Nonce asignado:", nonce)
+
+    # Sin "from": no forma parte de la tx firmada y eth-account lo validaría contra la cuenta
+    tx = {
+        "to": CONTRACT_BYTES,
+        "nonce": nonce,
+        "gas": gas,
+        "maxFeePerGas": tarifas_cache["maxFeePerGas"],
+        "maxPriorityFeePerGas": tarifas_cache["maxPriorityFeePerGas"],
+        "chainId": CHAIN_ID,
+        "type": 2,
+        "data": data,
+        "value": 0,
+    }
+
+    print("[DEBUG] TX Construida:", tx)
+
+    try:
+        # LocalAccount conserva la clave ya derivada (no se re-parsea por tx)
+        signed_tx = account.sign_transaction(tx)
+        tx_hash = await w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+    except asyncio.CancelledError:
+        # Apagado con el nonce asignado: vuelve al pool para no dejar un hueco. Si la
+        # tx sí llegó al nodo, su reutilización fallará como "nonce usado" y se descartará.
+        await terminar_nonce(nonce, devolver=True)
+        raise
+    except Exception as e:
+        await liberar_nonce(nonce, e)
+        raise
+
+    await terminar_nonce(nonce, devolver=False)
+    return tx_hash
+
+
+async def encolar_envio(data: bytes, gas: Optional[int]) -> bytes:
+    futuro = asyncio.get_running_loop().create_future()
+    await cola_envios.put((data, gas, futuro, 0))
+    return await futuro
+
+
+async def trabajador_envios():
+    while True:
+        data, gas, futuro, intentos = await cola_envios.get()
+        try:
+            tx_hash = await enviar_transaccion(data, gas)
+        except Exception as e:
+            if intentos < ENVIO_MAX_REINTENTOS:
+                print("[WARN] Envío fallido, reencolando:", e)
+                await cola_envios.put((data, gas, futuro, intentos + 1))
+            elif not futuro.done():
+                futuro.set_exception(e)
+            continue
+
+        print("[INFO] Tx enviada:", tx_hash.hex())
+        esperar_recibo_en_segundo_plano(tx_hash)
+        if not futuro.done():
+            futuro.set_result(tx_hash)
+
+
+# ================== LOTES (MODO=lote / MODO=merkle) ==================
+# Las lecturas que llegan dentro de una ventana corta se agrupan en una sola
+# tx (storeReadings o commitBatch), repartiendo el coste base entre todas.
+cola_lecturas = asyncio.Queue()
+
+
+async def encolar_lectura(device_id: str, temp_times10: int, hum_times10: int, timestamp_ms: int, cid: str) -> bytes:
+    futuro = asyncio.get_running_loop().create_future()
+    await cola_lecturas.put(((device_id, temp_times10, hum_times10, timestamp_ms, cid), futuro))
+    return await futuro
+
+
+async def enviar_lote(lote: list):
+    print("[INFO] Enviando lote de", len(lote), "lecturas")
+    lecturas = [lectura for lectura, _ in lote]
+    futuros = [futuro for _, futuro in lote]
+
+    try:
+        if MODO == "merkle":
+            niveles = construir_arbol_merkle([hoja_merkle(*lectura) for lectura in lecturas])
+            manifest_cid = await subir_a_pinata({
+                "root": "0x" + niveles[-1][0].hex(),
+                "readings": [
+                    {
+                        "device_id": device_id,
+                        "temperature_times10": temp_times10,
+                        "humidity_times10": hum_times10,
+                        "timestamp_ms": timestamp_ms,
+                        "cid": cid,
+                        "leaf": "0x" + hoja.hex(),
+                    }
+                    for (device_id, temp_times10, hum_times10, timestamp_ms, cid), hoja
+                    in zip(lecturas, niveles[0])
+                ],
+            })
+            if not manifest_cid:
+                raise RuntimeError("No se pudo subir el manifiesto del lote a Pinata")
+            data = SELECTOR_COMMIT_BATCH + encode(TIPOS_COMMIT_BATCH, [niveles[-1][0], manifest_cid])
+        else:
+            device_ids, temps, hums, timestamps, _ = (list(c) for c in zip(*lecturas))
+            data = SELECTOR_STORE_READINGS + encode(
+                TIPOS_STORE_READINGS, [device_ids, temps, hums, timestamps]
+            )
+
+        # Sin gas fijo: el límite se estima una vez por lote
+        tx_hash = await encolar_envio(data, gas=None)
+
+        if MODO == "merkle":
+            await registrar_pruebas(niveles, tx_hash, manifest_cid)
+    except Exception as e:
+        print("[ERROR] Error enviando lote:")
+        traceback.print_exc()
+        for futuro in futuros:
+            if not futuro.done():
+                futuro.set_exception(e)
+        return
+
+    for futuro in futuros:
+        if not futuro.done():
+            futuro.set_result(tx_hash)
+
+
+async def consumidor_lotes():
+    while True:
+        lote = [await cola_lecturas.get()]
+        limite = time.monotonic() + LOTE_MAX_ESPERA_MS / 1000
+
+        while len(lote) < LOTE_MAX_LECTURAS:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(await asyncio.wait_for(cola_lecturas.get(), restante))
+            except asyncio.TimeoutError:
+                break
+
+        # Un lote fallido no debe parar al consumidor: las lecturas siguientes se quedarían colgadas
+        try:
+            await enviar_lote(lote)
+        except Exception as e:
+            print("[ERROR] Error inesperado procesando lote:", e)
+            traceback.print_exc()
+            for _, futuro in lote:
+                if not futuro.done():
+                    futuro.set_exception(e)
+
+
+tareas_fondo = set()
+
+
+def lanzar_tarea_de_fondo(coro):
+    tarea = asyncio.create_task(coro)
+    tareas_fondo.add(tarea)
+    tarea.add_done_callback(tareas_fondo.discard)
+
+
+async def verificar_conexion():
+    if not await w3.is_connected():
+        raise RuntimeError("No se pudo conectar al nodo RPC. Revisa RPC_URL / Internet.")
+    print("[INFO] Saldo actual:", await w3.eth.get_balance(account.address))
+    if REDIS_URL:
+        await conectar_redis()
+    async with nonce_lock:
+        await sincronizar_nonce(arranque=True)
+
+    await asyncio.gather(refrescar_tarifas(), estimar_gas_store_reading())
+    lanzar_tarea_de_fondo(refrescador_tarifas())
+    lanzar_tarea_de_fondo(vigilante_nonce())
+    lanzar_tarea_de_fondo(sondeador_recibos())
+    for _ in range(ENVIO_TRABAJADORES):
+        lanzar_tarea_de_fondo(trabajador_envios())
+
+    if MODO in ("lote", "merkle"):
+        lanzar_tarea_de_fondo(consumidor_lotes())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sesion = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=64, ttl_dns_cache=300, keepalive_timeout=60)
+    )
+    http_state["session"] = sesion
+    await w3.provider.cache_async_session(sesion)
+
+    try:
+        await verificar_conexion()
+        yield
+    finally:
+        tareas = list(tareas_fondo)
+        for tarea in tareas:
+            tarea.cancel()
+        # Esperar a que los trabajadores devuelvan sus nonces antes de cerrar Redis
+        await asyncio.gather(*tareas, return_exceptions=True)
+        if redis_state["client"] is not None:
+            await redis_state["client"].aclose()
+        await sesion.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Modelos de respuesta: con ellos FastAPI serializa directamente a bytes JSON vía
+# pydantic-core, sin pasar por jsonable_encoder ni json.dumps
+class RespuestaLectura(BaseModel):
+    status: str
+    tx_hash: str
+    cid: str
+    leaf: Optional[str] = None
+
+
+class EstadoTx(BaseModel):
+    tx_hash: str
+    status: str
+    block: Optional[int] = None
+
+
+class PruebaMerkle(BaseModel):
+    leaf: str
+    root: str
+    proof: list[str]
+    manifest_cid: str
+    tx_hash: str
 
 
 @app.get("/")
-def root():
+def root() -> dict:
     return {"status": "ok", "message": "Relayer funcionando"}
 
 
-def subir_a_pinata(payload: dict) -> Optional[str]:
+@app.get("/api/tx/{tx_hash}", response_model=EstadoTx, response_model_exclude_none=True)
+async def estado_tx(tx_hash: str):
+    if not HASH_32_BYTES.fullmatch(tx_hash):
+        raise HTTPException(status_code=400, detail="tx_hash debe ser un hash hex de 32 bytes")
+
+    estado = recibos.get(clave_tx(tx_hash))
+    if estado is None:
+        estado = await consultar_estado_tx("0x" + clave_tx(tx_hash))
+    return {"tx_hash": tx_hash, **estado}
+
+
+async def consultar_estado_tx(tx_hash: str) -> dict:
+    """Estado de una tx que no envió este worker (pudo enviarla otro): se pregunta al nodo."""
+    try:
+        try:
+            receipt = await w3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            # Sin recibo: puede estar aún en el mempool
+            try:
+                await w3.eth.get_transaction(tx_hash)
+            except TransactionNotFound:
+                raise HTTPException(status_code=404, detail="Transacción desconocida")
+            return {"status": "pending"}
+    except Web3RPCError as e:
+        raise HTTPException(status_code=502, detail=f"Error consultando el nodo RPC: {e}")
+
+    return {
+        "status": "ok" if receipt.status == 1 else "reverted",
+        "block": receipt.blockNumber,
+    }
+
+
+if MODO == "merkle":
+    @app.get("/api/proof/{leaf_hash}", response_model=PruebaMerkle)
+    async def prueba_lectura(leaf_hash: str):
+        prueba = await buscar_prueba("0x" + leaf_hash.lower().removeprefix("0x"))
+        if prueba is None:
+            raise HTTPException(status_code=404, detail="Hoja desconocida")
+        return {"leaf": leaf_hash, **prueba}
+
+
+async def subir_a_pinata(payload: dict) -> Optional[str]:
     if not PINATA_JWT:
         print("[WARN] PINATA_JWT vacío, no se subirá a IPFS.")
         return None
@@ -76,11 +808,14 @@ def subir_a_pinata(payload: dict) -> Optional[str]:
     print("[DEBUG] Subiendo a Pinata:", payload)
 
     try:
-        r = requests.post(PINATA_URL, json=payload, headers=headers, timeout=30)
-        print("[DEBUG] Respuesta completa de Pinata:", r.text)
+        async with http_state["session"].post(
+            PINATA_URL, data=orjson.dumps(payload), headers=headers, timeout=PINATA_TIMEOUT
+        ) as r:
+            texto = await r.text()
+            print("[DEBUG] Respuesta completa de Pinata:", texto)
 
-        r.raise_for_status()
-        cid = r.json().get("IpfsHash")
+            r.raise_for_status()
+            cid = orjson.loads(texto).get("IpfsHash")
 
         print("[INFO] Subido a Pinata, CID:", cid)
         return cid
@@ -90,43 +825,56 @@ def subir_a_pinata(payload: dict) -> Optional[str]:
         return None
 
 
-@app.post("/api/lecturas")
-async def recibir_lectura(req: Request):
-    try:
-        data = await req.json()
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"JSON inválido: {e}")
+class Lectura(BaseModel):
+    # NaN/Infinity no son lecturas válidas (y no se pueden escalar a entero)
+    model_config = ConfigDict(allow_inf_nan=False)
 
-    print("[DEBUG] Payload recibido:", data)
-    device_id = data.get("device_id", "unknown-device")
+    device_id: str = Field("unknown-device", max_length=DEVICE_ID_MAX_CHARS)
+    # Límites del contrato tras escalar x10: int16 / uint16
+    temperature: float = Field(ge=INT16_MIN / 10, le=INT16_MAX / 10)
+    humidity: float = Field(ge=0, le=UINT16_MAX / 10)
+    timestamp_ms: int = Field(ge=0)
+    image: Optional[str] = None
 
-    # Validación de campos obligatorios
-    if "temperature" not in data:
-        raise HTTPException(status_code=400, detail="Campo 'temperature' requerido")
-    if "humidity" not in data:
-        raise HTTPException(status_code=400, detail="Campo 'humidity' requerido")
-    if "timestamp_ms" not in data:
-        raise HTTPException(status_code=400, detail="Campo 'timestamp_ms' requerido")
 
-    # Conversión de tipos
+@app.post(
+    "/api/lecturas",
+    status_code=202,
+    response_model=RespuestaLectura,
+    response_model_exclude_none=True,
+)
+async def recibir_lectura(req: Request):
+    # pydantic-core parsea y valida el JSON en una sola pasada; se responde 400
+    # (no el 422 por defecto de FastAPI) para no cambiar el contrato con los dispositivos
     try:
-        temp_c = float(data["temperature"])
-        hum = float(data["humidity"])
-        timestamp_ms = int(data["timestamp_ms"])
-    except (ValueError, TypeError) as e:
-        raise HTTPException(status_code=400, detail=f"Error en tipos de datos: {e}")
+        lectura = Lectura.model_validate_json(await req.body())
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Payload inválido: {e}")
+
+    print("[DEBUG] Payload recibido:", lectura)
+    device_id = lectura.device_id
+    temp_c = lectura.temperature
+    hum = lectura.humidity
+    timestamp_ms = lectura.timestamp_ms
 
     # Escalamiento para el contrato
     temp_times10 = int(round(temp_c * 10))
     hum_times10 = int(round(hum * 10))
 
-    # Subir a Pinata
-    cid = subir_a_pinata({
+    payload_ipfs = {
         "device_id": device_id,
         "temperature_c": temp_c,
         "humidity_percent": hum,
         "timestamp_ms": timestamp_ms,
-    }) or ""
+    }
+    if lectura.image is not None:
+        payload_ipfs["image"] = lectura.image
+
+    # Subir a Pinata solo si aporta algo que el contrato no guarda
+    # (tarifas y nonce ya están en caché: ninguna RPC antes del envío)
+    cid = ""
+    if "image" in payload_ipfs or len(orjson.dumps(payload_ipfs)) > PINATA_UMBRAL_BYTES:
+        cid = await subir_a_pinata(payload_ipfs) or ""
 
     # Debug
     print("====== DATOS QUE SE ENVIAN AL CONTRATO ======")
@@ -138,40 +886,27 @@ async def recibir_lectura(req: Request):
     print("================================================")
 
     try:
-        nonce = w3.eth.get_transaction_count(account.address)
-        print("[INFO] Nonce actual:", nonce)
-
-        tx = contract.functions.storeReading(
-            device_id,
-            temp_times10,
-            hum_times10,
-            timestamp_ms
-        ).build_transaction(
-            {
-                "from": account.address,
-                "nonce": nonce,
-                "gas": 300000,
-                "gasPrice": w3.eth.gas_price,
-                "chainId": CHAIN_ID,
-            }
-        )
-
-        print("[DEBUG] TX Construida:", tx)
-
-        signed_tx = w3.eth.account.sign_transaction(tx, private_key=PRIVATE_KEY)
-
-        tx_hash = w3.eth.send_raw_transaction(signed_tx.raw_transaction)
-        print("[INFO] Tx enviada:", tx_hash.hex())
-
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-        print("[INFO] Tx minada en bloque:", receipt.blockNumber)
-
-        return {
-            "status": "ok",
+        if MODO in ("lote", "merkle"):
+            tx_hash = await encolar_lectura(device_id, temp_times10, hum_times10, timestamp_ms, cid)
+        else:
+            tx_hash = await encolar_envio(
+                SELECTOR_STORE_READING + encode(
+                    TIPOS_STORE_READING,
+                    [device_id, temp_times10, hum_times10, timestamp_ms]
+                ),
+                # El límite precalculado solo cubre ids de hasta DEVICE_ID_GAS_BYTES bytes (UTF-8)
+                gas_state["storeReading"]
+                if len(device_id.encode()) <= DEVICE_ID_GAS_BYTES else None,
+            )
+
+        respuesta = {
+            "status": "pending",
             "tx_hash": tx_hash.hex(),
-            "block": receipt.blockNumber,
             "cid": cid,
         }
+        if MODO == "merkle":
+            respuesta["leaf"] = "0x" + hoja_merkle(device_id, temp_times10, hum_times10, timestamp_ms, cid).hex()
+        return respuesta
 
     except Exception as e:
         print("[ERROR] Exception completa al enviar tx:")
@@ -180,3 +915,23 @@ async def recibir_lectura(req: Request):
             status_code=500,
             detail=f"Error al enviar transacción: {str(e)}"
         )
+
+
+if __name__ == "__main__":
+    # uvloop + httptools (uvicorn[standard]). Varios workers solo con REDIS_URL:
+    # sin Redis cada uno tendría su propio nonce y sus propias pruebas Merkle
+    WORKERS = int(os.getenv("WORKERS", "1"))
+    if WORKERS > 1 and not REDIS_URL:
+        raise ValueError("WORKERS > 1 requiere REDIS_URL para compartir el nonce entre workers")
+
+    import uvicorn
+
+    uvicorn.run(
+        "relayer:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=WORKERS,
+        backlog=2048,
+    )
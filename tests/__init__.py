@@ -0,0 +1,12 @@
+# relayer.py lee su configuración al importarse: valores de prueba (nunca se
+# conecta al nodo, los tests sustituyen las llamadas RPC que usan)
+import os
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+os.environ.setdefault("RPC_URL", "http://127.0.0.1:8545")
+os.environ.setdefault("PRIVATE_KEY", "0x" + "11" * 32)
+os.environ.setdefault("CONTRACT_ADDRESS", "0x000000000000000000000000000000000000dEaD")
+os.environ.setdefault("CHAIN_ID", "11155111")
@@ -0,0 +1,47 @@
+import unittest
+
+from eth_utils import keccak
+
+import relayer
+
+
+def raiz_desde_prueba(hoja: bytes, prueba: list) -> bytes:
+    """Mismo cálculo que MerkleProof.processProof de OpenZeppelin (pares ordenados)."""
+    actual = hoja
+    for hermano in prueba:
+        a, b = sorted((actual, hermano))
+        actual = keccak(a + b)
+    return actual
+
+
+def hojas_de_prueba(cuantas: int) -> list:
+    return [
+        relayer.hoja_merkle(f"sensor-{i}", 250 + i, 500 - i, 1_700_000_000_000 + i, f"cid-{i}")
+        for i in range(cuantas)
+    ]
+
+
+class ArbolMerkleTest(unittest.TestCase):
+
+    def test_cada_prueba_reconstruye_la_raiz(self):
+        for cuantas in range(1, 12):
+            niveles = relayer.construir_arbol_merkle(hojas_de_prueba(cuantas))
+            raiz = niveles[-1][0]
+            for i, hoja in enumerate(niveles[0]):
+                with self.subTest(hojas=cuantas, indice=i):
+                    self.assertEqual(raiz_desde_prueba(hoja, relayer.prueba_merkle(niveles, i)), raiz)
+
+    def test_una_hoja_es_la_raiz(self):
+        hojas = hojas_de_prueba(1)
+        niveles = relayer.construir_arbol_merkle(hojas)
+        self.assertEqual(niveles[-1][0], hojas[0])
+        self.assertEqual(relayer.prueba_merkle(niveles, 0), [])
+
+    def test_hoja_alterada_no_reconstruye_la_raiz(self):
+        niveles = relayer.construir_arbol_merkle(hojas_de_prueba(5))
+        alterada = relayer.hoja_merkle("sensor-2", 251, 498, 1_700_000_000_002, "cid-2")
+        self.assertNotEqual(raiz_desde_prueba(alterada, relayer.prueba_merkle(niveles, 2)), niveles[-1][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
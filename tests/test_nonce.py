@@ -0,0 +1,145 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+import relayer
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class NonceEnProcesoTest(unittest.IsolatedAsyncioTestCase):
+    """Caché de nonce en proceso; la subclase Redis repite los mismos casos."""
+
+    async def asyncSetUp(self):
+        self.pendiente = 0
+
+        async def get_transaction_count(direccion, bloque):
+            return self.pendiente
+
+        parche = mock.patch.object(relayer.w3.eth, "get_transaction_count", get_transaction_count)
+        parche.start()
+        self.addCleanup(parche.stop)
+
+        relayer.nonce_state.update(value=0, libres=[], en_vuelo=set(), hueco=None)
+        relayer.nonce_lock = asyncio.Lock()
+        await self.conectar()
+
+    async def conectar(self):
+        relayer.redis_state.update(client=None, scripts={})
+
+    async def sincronizar(self, pendiente: int, arranque: bool = False):
+        self.pendiente = pendiente
+        async with relayer.nonce_lock:
+            await relayer.sincronizar_nonce(arranque=arranque)
+
+    async def asignar(self, cuantos: int) -> list:
+        return [await relayer.siguiente_nonce() for _ in range(cuantos)]
+
+    async def test_nonces_consecutivos_desde_el_nodo(self):
+        await self.sincronizar(7, arranque=True)
+        self.assertEqual(await self.asignar(3), [7, 8, 9])
+
+    async def test_libres_se_reutilizan_antes_que_nuevos(self):
+        await self.sincronizar(0, arranque=True)
+        await self.asignar(4)
+        await relayer.terminar_nonce(2, devolver=True)
+        await relayer.liberar_nonce(1, RuntimeError("timeout"))
+        self.assertEqual(await self.asignar(3), [1, 2, 4])
+
+    async def test_nonce_usado_se_descarta_y_resincroniza(self):
+        await self.sincronizar(0, arranque=True)
+        await self.asignar(2)
+        self.pendiente = 5
+        await relayer.liberar_nonce(1, ValueError("nonce too low"))
+        self.assertEqual(await self.asignar(1), [5])
+
+    async def test_resincronizar_solo_avanza(self):
+        await self.sincronizar(10, arranque=True)
+        await self.sincronizar(4)
+        self.assertEqual(await self.asignar(1), [10])
+
+    async def test_resincronizar_descarta_libres_ya_usados(self):
+        await self.sincronizar(0, arranque=True)
+        await self.asignar(3)
+        for n in range(3):
+            await relayer.terminar_nonce(n, devolver=n != 2)
+        await self.sincronizar(1)
+        self.assertEqual(await self.asignar(2), [1, 3])
+
+    async def test_arranque_sin_nonces_en_vuelo_iguala_al_nodo(self):
+        await self.sincronizar(10, arranque=True)
+        await relayer.terminar_nonce(await relayer.siguiente_nonce(), devolver=False)
+        await self.sincronizar(4, arranque=True)
+        self.assertEqual(await self.asignar(1), [4])
+
+    async def test_arranque_con_nonces_en_vuelo_no_retrocede(self):
+        await self.sincronizar(10, arranque=True)
+        await self.asignar(1)
+        await self.sincronizar(4, arranque=True)
+        self.assertEqual(await self.asignar(1), [11])
+
+    async def test_hueco_se_repara_tras_dos_revisiones(self):
+        await self.sincronizar(3, arranque=True)
+        for n in await self.asignar(2):
+            await relayer.terminar_nonce(n, devolver=False)
+
+        # El nodo solo vio el nonce 3: el 4 se perdió
+        self.pendiente = 4
+        await relayer.revisar_hueco_nonce()
+        self.assertEqual(await self.asignar(1), [5])
+        await relayer.terminar_nonce(5, devolver=False)
+
+        await relayer.revisar_hueco_nonce()
+        await relayer.revisar_hueco_nonce()
+        self.assertEqual(await self.asignar(2), [4, 6])
+
+    async def test_hueco_no_se_repara_con_envios_en_vuelo(self):
+        await self.sincronizar(3, arranque=True)
+        await self.asignar(2)
+        for _ in range(3):
+            await relayer.revisar_hueco_nonce()
+        self.assertEqual(await self.asignar(1), [5])
+
+    async def test_hueco_no_se_repara_si_el_nodo_se_pone_al_dia(self):
+        await self.sincronizar(3, arranque=True)
+        for n in await self.asignar(2):
+            await relayer.terminar_nonce(n, devolver=False)
+
+        await relayer.revisar_hueco_nonce()
+        self.pendiente = 5
+        await relayer.revisar_hueco_nonce()
+        self.assertEqual(await self.asignar(1), [5])
+
+
+@unittest.skipIf(fakeredis is None, "requiere fakeredis")
+class NonceRedisTest(NonceEnProcesoTest):
+
+    async def conectar(self):
+        cliente = fakeredis.FakeAsyncRedis()
+        with mock.patch.object(relayer.redis, "from_url", return_value=cliente):
+            await relayer.conectar_redis()
+        self.addAsyncCleanup(self.desconectar)
+
+    async def desconectar(self):
+        await relayer.redis_state["client"].aclose()
+        relayer.redis_state.update(client=None, scripts={})
+
+    async def test_en_vuelo_caducado_no_bloquea_la_reparacion(self):
+        await self.sincronizar(3, arranque=True)
+        await self.asignar(2)
+        # Worker caído con los nonces 3 y 4 asignados hace tiempo
+        await relayer.redis_state["client"].zadd(
+            relayer.CLAVES_NONCE[2], {"3": 0, "4": time.time() - 2 * relayer.NONCE_EN_VUELO_MAX_S}
+        )
+        self.pendiente = 4
+        await relayer.revisar_hueco_nonce()
+        await relayer.revisar_hueco_nonce()
+        self.assertEqual(await self.asignar(2), [4, 5])
+
+
+if __name__ == "__main__":
+    unittest.main()